@@ -0,0 +1,404 @@
+"""
+Benchmarks for the Blog API.
+
+Each benchmark drives the ASGI app in-process against a throwaway database
+in a temporary directory and prints its results as plain text:
+
+    python bench.py sqlite-pragmas --seconds 5 --dir /var/lib/blog
+    python bench.py json-encode --comments 1000
+    python bench.py bulk-posts --posts 20000
+    python bench.py comment-writes --seconds 5 --writers 200
+    python bench.py search --posts 1000000
+    python bench.py suggest --titles 200000
+    python bench.py metrics-overhead --requests 2000
+"""
+
+import argparse
+import asyncio
+import itertools
+import math
+import os
+import random
+import tempfile
+import time
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import httpx
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import event, insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import main as blog
+from main import (
+    app, get_db, get_read_db, create_db_engine, post_detail, post_detail_payload, Base, BlogPost,
+    BlogPostResponse, CommentWriter, MetricsMiddleware, Settings, TitleIndex
+)
+
+
+async def setup_database(path: str, settings: Settings):
+    engine = create_db_engine(f"sqlite+aiosqlite:///{path}", settings)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    session_factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+    async def bench_get_db():
+        async with session_factory() as db:
+            yield db
+
+    app.dependency_overrides[get_db] = bench_get_db
+    app.dependency_overrides[get_read_db] = bench_get_db
+    return engine
+
+
+async def run_sqlite_pragmas(path: str, settings: Settings, seconds: float, readers: int, writers: int):
+    engine = await setup_database(path, settings)
+    reads = writes = 0
+    deadline = time.perf_counter() + seconds
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        post_id = (await client.post("/api/posts", json={"title": "Live", "content": "x" * 2000})).json()["id"]
+
+        async def reader():
+            nonlocal reads
+            while time.perf_counter() < deadline:
+                response = await client.get(f"/api/posts/{post_id}")
+                assert response.status_code == 200
+                reads += 1
+
+        async def writer():
+            nonlocal writes
+            while time.perf_counter() < deadline:
+                response = await client.post(
+                    f"/api/posts/{post_id}/comments", json={"content": "Live comment", "author": "Bench"}
+                )
+                assert response.status_code == 201
+                writes += 1
+
+        await asyncio.gather(*[reader() for _ in range(readers)], *[writer() for _ in range(writers)])
+
+    await engine.dispose()
+    return reads / seconds, writes / seconds
+
+
+def bench_sqlite_pragmas(args):
+    """Read throughput of GET /api/posts/{id} while create_comment writes are in flight."""
+    profiles = {
+        "default pragmas": Settings(sqlite_pragmas_enabled=False),
+        "tuned pragmas": Settings(),
+    }
+    print(f"{args.readers} readers, {args.writers} writers, {args.seconds}s per profile")
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for name, settings in profiles.items():
+            path = os.path.join(tmp, f"{name.split()[0]}.db")
+            reads, writes = asyncio.run(
+                run_sqlite_pragmas(path, settings, args.seconds, args.readers, args.writers)
+            )
+            print(f"{name:>16}: {reads:8.1f} reads/s  {writes:8.1f} writes/s")
+
+
+def bench_json_encode(args):
+    """Encode time of a post detail with many comments, default path versus orjson."""
+    now = datetime.utcnow()
+    post = SimpleNamespace(
+        id=1, title="A viral post", content="x" * 4000, created_at=now, updated_at=now,
+        comment_count=args.comments
+    )
+    comments = [
+        SimpleNamespace(id=i, content=f"Comment number {i}", author=f"author{i % 50}",
+                        created_at=now + timedelta(seconds=i))
+        for i in range(args.comments)
+    ]
+
+    def fastapi_default():
+        # ORM/rows -> pydantic model -> jsonable_encoder -> json.dumps, as the
+        # endpoints did when they returned a response_model.
+        model = BlogPostResponse(**post_detail_payload(post, comments))
+        return JSONResponse(jsonable_encoder(model)).body
+
+    def pydantic_dump():
+        return post_detail.dump_json(post_detail.validate_python(post_detail_payload(post, comments)))
+
+    def orjson_rows():
+        return orjson.dumps(post_detail_payload(post, comments))
+
+    print(f"post detail with {args.comments} comments, best of {args.repeat} x {args.number}")
+    for name, encode in [("fastapi default", fastapi_default), ("pydantic dump_json", pydantic_dump),
+                         ("orjson from rows", orjson_rows)]:
+        best = min(timeit.repeat(encode, number=args.number, repeat=args.repeat)) / args.number
+        print(f"{name:>20}: {best * 1e6:10.1f} us/response  ({len(encode())} bytes)")
+
+
+async def run_bulk_posts(path: str, posts: int, batch: int):
+    engine = await setup_database(path, Settings())
+    items = [{"title": f"Imported post {i}", "content": "x" * 500} for i in range(posts)]
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        for item in items:
+            response = await client.post("/api/posts", json=item)
+            assert response.status_code == 201
+        single = posts / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for offset in range(0, posts, batch):
+            response = await client.post("/api/posts/bulk", json=items[offset:offset + batch])
+            assert response.status_code == 201
+        bulk = posts / (time.perf_counter() - start)
+
+    await engine.dispose()
+    return single, bulk
+
+
+def bench_bulk_posts(args):
+    """Rows per second through POST /api/posts versus POST /api/posts/bulk."""
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        single, bulk = asyncio.run(run_bulk_posts(os.path.join(tmp, "bulk.db"), args.posts, args.batch))
+    print(f"{args.posts} posts, {args.batch} per bulk request")
+    print(f"{'POST /api/posts':>20}: {single:10.0f} rows/s")
+    print(f"{'POST /api/posts/bulk':>20}: {bulk:10.0f} rows/s  ({bulk / single:.1f}x)")
+
+
+async def run_comment_writes(path: str, mode: str, seconds: float, writers: int, batch_size: int,
+                             window_ms: float):
+    engine = await setup_database(path, Settings())
+    session_factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    blog.settings.comment_write_mode = mode
+    blog.comment_writer = CommentWriter(session_factory, batch_size, window_ms / 1000)
+    commits = 0
+    latencies = []
+
+    def count_commit(conn):
+        nonlocal commits
+        commits += 1
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench", timeout=None) as client:
+        post_id = (await client.post("/api/posts", json={"title": "Live", "content": "Live event"})).json()["id"]
+        event.listen(engine.sync_engine, "commit", count_commit)
+        deadline = time.perf_counter() + seconds
+
+        async def writer():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await client.post(
+                    f"/api/posts/{post_id}/comments", json={"content": "Live comment", "author": "Bench"}
+                )
+                latencies.append(time.perf_counter() - start)
+                assert response.status_code in (201, 202)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[writer() for _ in range(writers)])
+        await blog.comment_writer.stop()
+        elapsed = time.perf_counter() - start
+        event.remove(engine.sync_engine, "commit", count_commit)
+
+    await engine.dispose()
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return len(latencies) / elapsed, commits / elapsed, p99
+
+
+def bench_comment_writes(args):
+    """Comment throughput, commits per second and p99 latency for each comment_write_mode."""
+    print(f"{args.writers} concurrent writers, {args.seconds}s per mode, "
+          f"batches of up to {args.batch_size} within {args.window_ms}ms")
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for mode in ["direct", "group_commit", "write_behind"]:
+            comments, commits, p99 = asyncio.run(run_comment_writes(
+                os.path.join(tmp, f"{mode}.db"), mode, args.seconds, args.writers, args.batch_size,
+                args.window_ms
+            ))
+            print(f"{mode:>13}: {comments:8.0f} comments/s  {commits:8.1f} commits/s  "
+                  f"p99 {p99 * 1000:7.1f} ms")
+
+
+async def run_search(path: str, posts: int, queries: int, seed: int):
+    engine = await setup_database(path, Settings())
+    rng = random.Random(seed)
+    # Zipf-ish vocabulary: a few words appear in most posts, most words in few.
+    vocabulary = [f"word{i}" for i in range(50000)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+
+    def text_of(words):
+        return " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=words))
+
+    start = time.perf_counter()
+    async with engine.begin() as conn:
+        for offset in range(0, posts, 10000):
+            await conn.execute(insert(BlogPost), [
+                {"title": text_of(6), "content": text_of(80)} for _ in range(min(10000, posts - offset))
+            ])
+    print(f"indexed {posts} posts in {time.perf_counter() - start:.1f}s")
+
+    terms = {
+        "common": vocabulary[:10],
+        "mid": vocabulary[100:110],
+        "rare": vocabulary[20000:20010],
+        "two words": [f"{vocabulary[50 + i]} {vocabulary[500 + i]}" for i in range(10)],
+    }
+    results = {}
+    async with httpx.AsyncClient(app=app, base_url="http://bench", timeout=None) as client:
+        for name, words in terms.items():
+            latencies = []
+            for i in range(queries):
+                begin = time.perf_counter()
+                response = await client.get("/api/search", params={"q": words[i % len(words)]})
+                latencies.append(time.perf_counter() - begin)
+                assert response.status_code == 200
+            latencies.sort()
+            results[name] = (latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)])
+
+        # What the frontend's filtering amounts to: a scan over every post.
+        async with engine.connect() as conn:
+            begin = time.perf_counter()
+            for word in terms["rare"]:
+                await conn.execute(select(BlogPost.id).where(BlogPost.content.contains(word)).limit(20))
+            scan = (time.perf_counter() - begin) / len(terms["rare"])
+
+    await engine.dispose()
+    return results, scan
+
+
+def bench_search(args):
+    """Latency of GET /api/search on a synthetic corpus against a LIKE scan."""
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        results, scan = asyncio.run(
+            run_search(os.path.join(tmp, "search.db"), args.posts, args.queries, args.seed)
+        )
+    print(f"{args.queries} queries per term class")
+    for name, (p50, p99) in results.items():
+        print(f"{name:>10}: p50 {p50 * 1000:8.2f} ms  p99 {p99 * 1000:8.2f} ms")
+    print(f"{'LIKE scan':>10}: {scan * 1000:8.2f} ms per rare term")
+
+
+def bench_suggest(args):
+    """Lookup latency and memory of the in-memory title index behind GET /api/posts/suggest."""
+    rng = random.Random(args.seed)
+    words = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz", k=rng.randint(3, 9))) for _ in range(20000)]
+    titles = [" ".join(rng.choices(words, k=rng.randint(3, 8))) for _ in range(args.titles)]
+
+    tracemalloc.start()
+    index = TitleIndex(max_titles=args.titles, refresh_seconds=60)
+    start = time.perf_counter()
+    index.add_many(list(enumerate(titles, start=1)))
+    built = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"{args.titles} titles: built in {built:.2f}s, {memory / 2**20:.1f} MiB")
+    for length in [1, 2, 4, 8]:
+        prefixes = [title[:length] for title in rng.sample(titles, 1000)]
+        best = min(timeit.repeat(
+            lambda: [index.suggest(prefix, args.limit) for prefix in prefixes], number=1, repeat=5
+        )) / len(prefixes)
+        print(f"prefix of {length} chars: {best * 1e6:8.1f} us per lookup (top {args.limit})")
+
+
+async def run_metrics_overhead(path: str, requests: int, calls: int):
+    # The middleware on its own, around an ASGI app that does nothing.
+    async def noop_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def noop_send(message):
+        pass
+
+    scope = {"type": "http", "method": "GET", "path": "/api/posts/1"}
+    middleware = MetricsMiddleware(noop_app)
+    per_call = {}
+    for name, target in [("bare app", noop_app), ("with metrics", middleware)]:
+        start = time.perf_counter()
+        for _ in range(calls):
+            await target(dict(scope), None, noop_send)
+        per_call[name] = (time.perf_counter() - start) / calls
+
+    # End to end on a real route, with the middleware switched off and on.
+    engine = await setup_database(path, Settings())
+    per_request = {}
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        post_id = (await client.post("/api/posts", json={"title": "Hot", "content": "x" * 2000})).json()["id"]
+        for name, enabled in [("metrics off", False), ("metrics on", True), ("metrics off", False)]:
+            blog.settings.metrics_enabled = enabled
+            start = time.perf_counter()
+            for _ in range(requests):
+                assert (await client.get(f"/api/posts/{post_id}")).status_code == 200
+            per_request[name] = min(per_request.get(name, math.inf), (time.perf_counter() - start) / requests)
+    blog.settings.metrics_enabled = True
+    await engine.dispose()
+    return per_call, per_request
+
+
+def bench_metrics_overhead(args):
+    """Per-request cost of MetricsMiddleware, alone and on GET /api/posts/{id}."""
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        per_call, per_request = asyncio.run(
+            run_metrics_overhead(os.path.join(tmp, "metrics.db"), args.requests, args.calls)
+        )
+    for name, seconds in per_call.items():
+        print(f"{name:>14}: {seconds * 1e6:8.2f} us per call")
+    print(f"{'overhead':>14}: {(per_call['with metrics'] - per_call['bare app']) * 1e6:8.2f} us per request")
+    for name, seconds in per_request.items():
+        print(f"{name:>14}: {seconds * 1e6:8.1f} us per GET /api/posts/{{id}}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pragmas = commands.add_parser("sqlite-pragmas", help=bench_sqlite_pragmas.__doc__)
+    pragmas.add_argument("--seconds", type=float, default=5.0)
+    pragmas.add_argument("--readers", type=int, default=8)
+    pragmas.add_argument("--writers", type=int, default=2)
+    pragmas.add_argument("--dir", help="directory for the database files (use the production disk)")
+    pragmas.set_defaults(func=bench_sqlite_pragmas)
+
+    encode = commands.add_parser("json-encode", help=bench_json_encode.__doc__)
+    encode.add_argument("--comments", type=int, default=1000)
+    encode.add_argument("--number", type=int, default=50)
+    encode.add_argument("--repeat", type=int, default=5)
+    encode.set_defaults(func=bench_json_encode)
+
+    bulk = commands.add_parser("bulk-posts", help=bench_bulk_posts.__doc__)
+    bulk.add_argument("--posts", type=int, default=20000)
+    bulk.add_argument("--batch", type=int, default=5000)
+    bulk.add_argument("--dir", help="directory for the database file")
+    bulk.set_defaults(func=bench_bulk_posts)
+
+    writes = commands.add_parser("comment-writes", help=bench_comment_writes.__doc__)
+    writes.add_argument("--seconds", type=float, default=5.0)
+    writes.add_argument("--writers", type=int, default=200)
+    writes.add_argument("--batch-size", type=int, default=500)
+    writes.add_argument("--window-ms", type=float, default=10.0)
+    writes.add_argument("--dir", help="directory for the database files (use the production disk)")
+    writes.set_defaults(func=bench_comment_writes)
+
+    search = commands.add_parser("search", help=bench_search.__doc__)
+    search.add_argument("--posts", type=int, default=1_000_000)
+    search.add_argument("--queries", type=int, default=200)
+    search.add_argument("--seed", type=int, default=0)
+    search.add_argument("--dir", help="directory for the database file")
+    search.set_defaults(func=bench_search)
+
+    suggest = commands.add_parser("suggest", help=bench_suggest.__doc__)
+    suggest.add_argument("--titles", type=int, default=200_000)
+    suggest.add_argument("--limit", type=int, default=10)
+    suggest.add_argument("--seed", type=int, default=0)
+    suggest.set_defaults(func=bench_suggest)
+
+    overhead = commands.add_parser("metrics-overhead", help=bench_metrics_overhead.__doc__)
+    overhead.add_argument("--requests", type=int, default=2000)
+    overhead.add_argument("--calls", type=int, default=100_000)
+    overhead.add_argument("--dir", help="directory for the database file")
+    overhead.set_defaults(func=bench_metrics_overhead)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,25 +3,58 @@ Test suite for Blog API
 Using pytest and FastAPI TestClient
 """
 
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from main import app, get_db, Base
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event, func, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, StaticPool
+import main
+from main import (
+    app, get_db, get_read_db, get_read_session_factory, create_db_engine, rebuild_search_index, recount_comment_counts,
+    response_cache, settings, Base, BlogPost, CacheBackend, Comment, CommentWriter, MemoryCache, ReadRouter,
+    QueryBudgetExceeded, QueryStats, RecordingPurger, RedisCache, Settings, TitleIndex, report_queries,
+    title_index
+)
 import json
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
+# TestClient runs every request on a fresh event loop, so connections must not
+# be pooled across requests.
+async_engine = create_db_engine(SQLALCHEMY_DATABASE_URL, Settings(db_pool_class="null"))
+TestingSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+# Schema setup and teardown run outside any event loop.
+engine = create_engine("sqlite:///./test.db")
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_read_db] = override_get_db
+app.dependency_overrides[get_read_session_factory] = lambda: TestingSessionLocal
+
+@contextmanager
+def count_queries():
+    """Collect every SQL statement executed against the test engine."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
 
 @pytest.fixture(scope="function")
 def test_db():
@@ -29,6 +62,21 @@ def test_db():
     Base.metadata.create_all(bind=engine)
     yield
     Base.metadata.drop_all(bind=engine)
+    response_cache.clear()
+    title_index.clear()
+
+
+# Any request over its route's query budget fails the test that made it.
+QUERY_BUDGETS = (
+    "get_all_posts=1,get_post=3,get_post_comments=2,create_post=1,create_comment=2,search=3,suggest_posts=1"
+)
+
+
+@pytest.fixture(autouse=True)
+def query_budgets(monkeypatch):
+    monkeypatch.setattr(settings, "sql_query_budgets", QUERY_BUDGETS)
+    monkeypatch.setattr(settings, "sql_query_budget", 10)
+    monkeypatch.setattr(settings, "sql_query_budget_action", "raise")
 
 
 @pytest.fixture
@@ -160,3 +208,1080 @@ def test_post_with_comments_integration(client, test_db):
     posts_response = client.get("/api/posts")
     posts_data = posts_response.json()
     assert posts_data[0]["comment_count"] == 2
+
+
+def test_get_posts_query_count_is_constant(client, test_db):
+    post_id = client.post("/api/posts", json={"title": "Post 0", "content": "Content"}).json()["id"]
+    client.post(f"/api/posts/{post_id}/comments", json={"content": "Hi", "author": "A"})
+
+    with count_queries() as statements:
+        client.get("/api/posts")
+    baseline = len(statements)
+
+    for i in range(1, 6):
+        post_id = client.post("/api/posts", json={"title": f"Post {i}", "content": "Content"}).json()["id"]
+        for _ in range(i):
+            client.post(f"/api/posts/{post_id}/comments", json={"content": "Hi", "author": "A"})
+
+    with count_queries() as statements:
+        response = client.get("/api/posts")
+    assert len(statements) == baseline
+
+    counts = {post["title"]: post["comment_count"] for post in response.json()}
+    assert counts == {f"Post {i}": max(i, 1) for i in range(6)}
+
+
+def test_get_posts_keyset_pagination(client, test_db):
+    for i in range(5):
+        client.post("/api/posts", json={"title": f"Post {i}", "content": "Content"})
+
+    titles = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/api/posts", params=params)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        titles.extend(post["title"] for post in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    assert titles == [f"Post {i}" for i in reversed(range(5))]
+
+
+def test_get_posts_pagination_limits(client, test_db):
+    assert client.get("/api/posts", params={"limit": 101}).status_code == 422
+    assert client.get("/api/posts", params={"limit": 0}).status_code == 422
+    assert client.get("/api/posts", params={"cursor": "not-a-cursor"}).status_code == 400
+
+
+def test_get_post_embeds_first_comments(client, test_db):
+    post_id = client.post("/api/posts", json={"title": "Viral", "content": "Content"}).json()["id"]
+    for i in range(5):
+        client.post(f"/api/posts/{post_id}/comments", json={"content": f"Comment {i}", "author": "A"})
+
+    response = client.get(f"/api/posts/{post_id}", params={"comments_limit": 2})
+    assert response.status_code == 200
+
+    data = response.json()
+    assert data["comment_count"] == 5
+    assert [c["content"] for c in data["comments"]] == ["Comment 0", "Comment 1"]
+
+    response = client.get(
+        f"/api/posts/{post_id}/comments",
+        params={"limit": 2, "cursor": data["comments_next_cursor"]}
+    )
+    assert [c["content"] for c in response.json()] == ["Comment 2", "Comment 3"]
+
+    response = client.get(
+        f"/api/posts/{post_id}/comments",
+        params={"limit": 2, "cursor": response.headers["X-Next-Cursor"]}
+    )
+    assert [c["content"] for c in response.json()] == ["Comment 4"]
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_get_post_without_comments(client, test_db):
+    post_id = client.post("/api/posts", json={"title": "Quiet", "content": "Content"}).json()["id"]
+    client.post(f"/api/posts/{post_id}/comments", json={"content": "Only one", "author": "A"})
+
+    response = client.get(f"/api/posts/{post_id}", params={"comments_limit": 0})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["comment_count"] == 1
+    assert data["comments"] == []
+    assert data["comments_next_cursor"] is None
+
+
+def test_get_comments_of_nonexistent_post(client, test_db):
+    response = client.get("/api/posts/999/comments")
+    assert response.status_code == 404
+
+
+def test_concurrent_requests(test_db):
+    async def run():
+        async with httpx.AsyncClient(app=app, base_url="http://test") as ac:
+            created = await asyncio.gather(*[
+                ac.post("/api/posts", json={"title": f"Post {i}", "content": "Content"})
+                for i in range(10)
+            ])
+            fetched = await asyncio.gather(*[
+                ac.get(f"/api/posts/{r.json()['id']}") for r in created
+            ])
+        return created, fetched
+
+    created, fetched = asyncio.run(run())
+    assert all(r.status_code == 201 for r in created)
+    assert all(r.status_code == 200 for r in fetched)
+
+
+def explain_query_plan(stmt):
+    compiled = stmt.compile(engine, compile_kwargs={"literal_binds": True})
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+    return " | ".join(row[-1] for row in rows)
+
+
+def test_query_plans_use_indexes(test_db):
+    plan = explain_query_plan(
+        select(Comment.id, Comment.content)
+        .where(Comment.blog_post_id == 1)
+        .order_by(Comment.created_at, Comment.id)
+        .limit(21)
+    )
+    assert "ix_comments_blog_post_id_created_at_id" in plan
+    assert "TEMP B-TREE" not in plan
+
+    plan = explain_query_plan(select(func.count(Comment.id)).where(Comment.blog_post_id == 1))
+    assert "COVERING INDEX ix_comments_blog_post_id_created_at_id" in plan
+
+    plan = explain_query_plan(
+        select(BlogPost.id, BlogPost.title)
+        .order_by(BlogPost.created_at.desc(), BlogPost.id.desc())
+        .limit(21)
+    )
+    assert "ix_blog_posts_created_at_id" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_comment_count_is_maintained(client, test_db):
+    post = client.post("/api/posts", json={"title": "Counted", "content": "Content"}).json()
+    for i in range(3):
+        client.post(f"/api/posts/{post['id']}/comments", json={"content": f"C{i}", "author": "A"})
+
+    assert client.get(f"/api/posts/{post['id']}").json()["comment_count"] == 3
+    # Comments don't count as an edit of the post itself.
+    assert client.get(f"/api/posts/{post['id']}").json()["updated_at"] == post["updated_at"]
+
+    with Session(engine) as db:
+        db.delete(db.scalars(select(Comment).limit(1)).one())
+        db.commit()
+
+    assert client.get("/api/posts").json()[0]["comment_count"] == 2
+
+
+def test_recount_comment_counts(client, test_db):
+    post_id = client.post("/api/posts", json={"title": "Drifted", "content": "Content"}).json()["id"]
+    client.post(f"/api/posts/{post_id}/comments", json={"content": "C", "author": "A"})
+
+    with engine.begin() as conn:
+        conn.execute(update(BlogPost).values(comment_count=42))
+
+    assert asyncio.run(recount_comment_counts(async_engine)) == 1
+    assert asyncio.run(recount_comment_counts(async_engine)) == 0
+    assert client.get(f"/api/posts/{post_id}").json()["comment_count"] == 1
+
+
+def test_sqlite_pragma_profile(test_db):
+    async def read_pragmas():
+        async with async_engine.connect() as conn:
+            return {
+                name: (await conn.execute(text(f"PRAGMA {name}"))).scalar()
+                for name in ("journal_mode", "synchronous", "busy_timeout", "temp_store", "foreign_keys")
+            }
+
+    pragmas = asyncio.run(read_pragmas())
+    assert pragmas["journal_mode"] == settings.sqlite_journal_mode.lower()
+    assert pragmas["synchronous"] == 1  # NORMAL
+    assert pragmas["busy_timeout"] == settings.sqlite_busy_timeout_ms
+    assert pragmas["temp_store"] == 2  # MEMORY
+    assert pragmas["foreign_keys"] == 1
+
+
+def test_settings_from_environment(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "sqlite+aiosqlite:///./other.db")
+    monkeypatch.setenv("DB_POOL_SIZE", "16")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "4")
+    monkeypatch.setenv("DB_POOL_RECYCLE", "1800")
+    monkeypatch.setenv("DB_POOL_PRE_PING", "true")
+
+    env_settings = Settings()
+    assert env_settings.database_url == "sqlite+aiosqlite:///./other.db"
+
+    pooled = create_db_engine("sqlite+aiosqlite:///./test.db", env_settings)
+    assert isinstance(pooled.pool, AsyncAdaptedQueuePool)
+    assert pooled.pool.size() == 16
+    assert pooled.pool._max_overflow == 4
+    assert pooled.pool._recycle == 1800
+    assert pooled.pool._pre_ping
+
+
+def test_settings_pool_class():
+    null = create_db_engine("sqlite+aiosqlite:///./test.db", Settings(db_pool_class="null"))
+    assert isinstance(null.pool, NullPool)
+    static = create_db_engine("sqlite+aiosqlite://", Settings(db_pool_class="static"))
+    assert isinstance(static.pool, StaticPool)
+
+    replica = create_db_engine("sqlite+aiosqlite://", Settings(db_pool_class="static"), label="replica-1")
+    asyncio.run(replica.dispose())
+    assert replica.pool.engine_label == "replica-1"
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    """Route reads through a ReadRouter with a second SQLite file as the replica."""
+    replica_engine = create_engine("sqlite:///./test_replica.db")
+    Base.metadata.create_all(bind=replica_engine)
+    replica_async_engine = create_db_engine(
+        "sqlite+aiosqlite:///./test_replica.db", Settings(db_pool_class="null"), label="replica-0"
+    )
+    router = ReadRouter(
+        TestingSessionLocal,
+        [async_sessionmaker(bind=replica_async_engine, expire_on_commit=False)],
+        sticky_seconds=5.0
+    )
+    monkeypatch.setattr("main.read_router", router)
+    # Keep responses served to the sticky writer out of other clients' way.
+    monkeypatch.setattr("main.response_cache", CacheBackend())
+    monkeypatch.delitem(app.dependency_overrides, get_read_db)
+    monkeypatch.delitem(app.dependency_overrides, get_read_session_factory)
+    yield replica_engine
+    Base.metadata.drop_all(bind=replica_engine)
+
+
+def test_reads_go_to_replica(client, test_db, replica):
+    with Session(replica) as db:
+        db.add(BlogPost(title="Only on replica", content="Content"))
+        db.commit()
+
+    response = client.get("/api/posts")
+    assert [post["title"] for post in response.json()] == ["Only on replica"]
+    # Checkout waits are told apart per database.
+    assert 'db_pool_checkout_wait_seconds_count{engine="replica-0",pool="null"}' in client.get("/metrics").text
+
+
+def test_export_opens_its_own_replica_session(client, test_db, replica):
+    with Session(replica) as db:
+        db.add(BlogPost(title="Exported from replica", content="Content"))
+        db.commit()
+
+    response = client.get("/api/export")
+    assert response.status_code == 200
+    assert [json.loads(line)["title"] for line in response.text.splitlines()] == ["Exported from replica"]
+
+
+def test_read_your_writes_sticks_to_primary(client, test_db, replica):
+    post_id = client.post("/api/posts", json={"title": "Fresh", "content": "Content"}).json()["id"]
+
+    # The writer reads from the primary while the replica hasn't caught up...
+    assert client.get(f"/api/posts/{post_id}").status_code == 200
+    # ...while everybody else is served by the replica.
+    assert TestClient(app).get(f"/api/posts/{post_id}").status_code == 404
+
+
+def test_replica_reads_do_not_refill_invalidated_entries(client, test_db, replica, monkeypatch):
+    cache = MemoryCache(max_bytes=1024 * 1024, ttl_seconds=60)
+    monkeypatch.setattr("main.response_cache", cache)
+    post_id = client.post("/api/posts", json={"title": "Lagging", "content": "Content"}).json()["id"]
+    with Session(replica) as db:
+        db.add(BlogPost(id=post_id, title="Lagging", content="Content"))
+        db.commit()
+
+    client.post(f"/api/posts/{post_id}/comments", json={"content": "New", "author": "A"})
+    reader = TestClient(app)
+    # The replica hasn't seen the comment yet; its answer must not be cached.
+    assert reader.get(f"/api/posts/{post_id}").json()["comment_count"] == 0
+    assert cache.stats()["entries"] == 0
+
+    with Session(replica) as db:
+        db.add(Comment(blog_post_id=post_id, content="New", author="A"))
+        db.execute(update(BlogPost).where(BlogPost.id == post_id).values(comment_count=1))
+        db.commit()
+    assert reader.get(f"/api/posts/{post_id}").json()["comment_count"] == 1
+
+
+def test_read_router_least_busy():
+    router = ReadRouter(None, ["a", "b", "c"], selection="least_busy")
+    router._in_use = [2, 0, 1]
+    assert router._pick_replica() == 1
+
+    router = ReadRouter(None, ["a", "b"])
+    assert [router._pick_replica() for _ in range(4)] == [0, 1, 0, 1]
+
+
+def test_post_detail_cache(client, test_db):
+    post_id = client.post("/api/posts", json={"title": "Cached", "content": "Content"}).json()["id"]
+    # The writer itself bypasses the cache during its read-your-writes window.
+    reader = TestClient(app)
+    hits = response_cache.hits
+
+    first = reader.get(f"/api/posts/{post_id}")
+    with count_queries() as statements:
+        second = reader.get(f"/api/posts/{post_id}")
+    assert statements == []
+    assert second.json() == first.json()
+    assert response_cache.hits == hits + 1
+
+    client.post(f"/api/posts/{post_id}/comments", json={"content": "New", "author": "A"})
+    data = reader.get(f"/api/posts/{post_id}").json()
+    assert data["comment_count"] == 1
+    assert [c["content"] for c in data["comments"]] == ["New"]
+
+    stats = reader.get("/api/cache/stats").json()
+    assert stats["backend"] == "memory"
+    assert stats["hits"] == response_cache.hits
+
+
+def test_write_during_a_read_keeps_its_response_out_of_the_cache(client, test_db, monkeypatch):
+    post_id = client.post("/api/posts", json={"title": "Racy", "content": "Content"}).json()["id"]
+    reader = TestClient(app)
+    get_comments_page = main.get_comments_page
+
+    async def comment_midway(db, *args, **kwargs):
+        # A comment lands after the reader has loaded the post row.
+        monkeypatch.setattr(main, "get_comments_page", get_comments_page)
+        with Session(engine) as other:
+            other.add(Comment(blog_post_id=post_id, content="Late", author="A"))
+            other.execute(update(BlogPost).where(BlogPost.id == post_id).values(comment_count=1))
+            other.commit()
+        await main.response_cache.invalidate([f"post-{post_id}"])
+        return await get_comments_page(db, *args, **kwargs)
+
+    monkeypatch.setattr(main, "get_comments_page", comment_midway)
+    assert reader.get(f"/api/posts/{post_id}").json()["comment_count"] == 0
+    assert reader.get(f"/api/posts/{post_id}").json()["comment_count"] == 1
+
+
+def test_post_list_cache(client, test_db):
+    reader = TestClient(app)
+    for i in range(3):
+        client.post("/api/posts", json={"title": f"Post {i}", "content": "Content"})
+
+    first = reader.get("/api/posts", params={"limit": 2})
+    with count_queries() as statements:
+        second = reader.get("/api/posts", params={"limit": 2})
+    assert statements == []
+    assert second.json() == first.json()
+    assert second.headers["X-Next-Cursor"] == first.headers["X-Next-Cursor"]
+
+    client.post("/api/posts", json={"title": "Post 3", "content": "Content"})
+    assert reader.get("/api/posts", params={"limit": 2}).json()[0]["title"] == "Post 3"
+
+
+def test_memory_cache_bounds():
+    async def run():
+        cache = MemoryCache(max_bytes=3 * (len(b"x" * 100) + 33) + 10, ttl_seconds=60)
+        for post_id in range(4):
+            await cache.set(f"post:{post_id}", b"x" * 100, [f"post-{post_id}"])
+        assert await cache.get("post:0") is None
+        assert await cache.get("post:3") == b"x" * 100
+        assert cache.evictions == 1
+        assert cache.size_bytes <= cache.max_bytes
+
+        await cache.invalidate(["post-3"])
+        assert await cache.get("post:3") is None
+
+        expired = MemoryCache(max_bytes=1024, ttl_seconds=-1)
+        await expired.set("post:1", b"body")
+        assert await expired.get("post:1") is None
+        assert expired.expirations == 1
+
+    asyncio.run(run())
+
+
+def test_redis_cache_pubsub_invalidation():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def run():
+        server = fakeredis.FakeServer()
+        workers = [
+            RedisCache(
+                fakeredis.aioredis.FakeRedis(server=server),
+                ttl_seconds=60,
+                local=MemoryCache(max_bytes=1024 * 1024, ttl_seconds=60)
+            )
+            for _ in range(2)
+        ]
+        for worker in workers:
+            await worker.start()
+
+        await workers[0].set("post:1:20", b"payload", ["post-1", "post-list"])
+        # The second worker finds the entry in Redis and keeps a local copy.
+        assert await workers[1].get("post:1:20") == b"payload"
+        assert await workers[1].local.get("post:1:20") == b"payload"
+
+        await workers[0].invalidate(["post-1"])
+        for _ in range(50):
+            if await workers[1].local.get("post:1:20") is None:
+                break
+            await asyncio.sleep(0.01)
+
+        assert await workers[1].local.get("post:1:20") is None
+        assert await workers[1].get("post:1:20") is None
+
+        for worker in workers:
+            await worker.stop()
+
+    asyncio.run(run())
+
+
+def test_redis_cache_resubscribes_after_disconnect():
+    fakeredis = pytest.importorskip("fakeredis")
+
+    async def run():
+        server = fakeredis.FakeServer()
+        writer = RedisCache(fakeredis.aioredis.FakeRedis(server=server), ttl_seconds=60)
+        reader = RedisCache(
+            fakeredis.aioredis.FakeRedis(server=server),
+            ttl_seconds=60,
+            local=MemoryCache(max_bytes=1024 * 1024, ttl_seconds=60),
+            reconnect_seconds=0.01
+        )
+        await reader.start()
+
+        server.connected = False
+        await asyncio.sleep(0.05)
+        server.connected = True
+        for _ in range(50):
+            if reader.errors and reader._listener is not None and not reader._listener.done():
+                break
+            await asyncio.sleep(0.01)
+        assert reader.errors
+
+        await writer.set("post:1:20", b"payload", ["post-1"])
+        assert await reader.get("post:1:20") == b"payload"
+        await writer.invalidate(["post-1"])
+        for _ in range(50):
+            if await reader.local.get("post:1:20") is None:
+                break
+            await asyncio.sleep(0.01)
+        assert await reader.local.get("post:1:20") is None
+
+        await reader.stop()
+
+    asyncio.run(run())
+
+
+def test_redis_outage_is_a_cache_miss(client, test_db, monkeypatch):
+    redis = pytest.importorskip("redis.asyncio")
+    # Nothing listens on port 1.
+    cache = RedisCache(redis.from_url("redis://127.0.0.1:1/0"), ttl_seconds=60)
+    monkeypatch.setattr("main.response_cache", cache)
+
+    response = client.post("/api/posts", json={"title": "Still works", "content": "Content"})
+    assert response.status_code == 201
+    response = TestClient(app).get("/api/posts")
+    assert response.status_code == 200
+    assert [post["title"] for post in response.json()] == ["Still works"]
+    assert cache.errors > 0
+
+
+def test_post_etag_and_last_modified(client, test_db):
+    post_id = client.post("/api/posts", json={"title": "Validated", "content": "Content"}).json()["id"]
+
+    # The writer is inside its read-your-writes window, so these requests skip
+    # the response cache and exercise the metadata query.
+    response = client.get(f"/api/posts/{post_id}")
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+    assert etag.startswith('"')
+
+    with count_queries() as statements:
+        response = client.get(f"/api/posts/{post_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+    assert len(statements) == 1
+    assert "comments.content" not in statements[0]
+
+    response = client.get(f"/api/posts/{post_id}", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+    # A comment changes the representation even though the post is unchanged.
+    client.post(f"/api/posts/{post_id}/comments", json={"content": "New", "author": "A"})
+    response = client.get(f"/api/posts/{post_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    # A different comments_limit is a different representation.
+    response = client.get(
+        f"/api/posts/{post_id}",
+        params={"comments_limit": 1},
+        headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert response.status_code == 200
+
+
+def test_cached_responses_answer_conditional_requests(client, test_db):
+    post_id = client.post("/api/posts", json={"title": "Validated", "content": "Content"}).json()["id"]
+    reader = TestClient(app)
+
+    etag = reader.get(f"/api/posts/{post_id}").headers["ETag"]
+    with count_queries() as statements:
+        response = reader.get(f"/api/posts/{post_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert statements == []
+
+    etag = reader.get("/api/posts").headers["ETag"]
+    assert reader.get("/api/posts", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post(f"/api/posts/{post_id}/comments", json={"content": "New", "author": "A"})
+    response = reader.get("/api/posts", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()[0]["comment_count"] == 1
+
+
+@pytest.fixture
+def purger(monkeypatch):
+    recording = RecordingPurger()
+    monkeypatch.setattr("main.purger", recording)
+    return recording
+
+
+def test_cdn_headers(client, test_db):
+    post_id = client.post("/api/posts", json={"title": "Edge", "content": "Content"}).json()["id"]
+    reader = TestClient(app)
+
+    response = reader.get("/api/posts")
+    assert response.headers["Cache-Control"] == settings.cache_control_post_list
+    assert response.headers["Surrogate-Key"] == f"post-list post-{post_id}"
+
+    response = reader.get(f"/api/posts/{post_id}")
+    assert response.headers["Cache-Control"] == settings.cache_control_post_detail
+    assert response.headers["Surrogate-Key"] == f"post-{post_id}"
+
+    response = reader.get(f"/api/posts/{post_id}", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert response.headers["Cache-Control"] == settings.cache_control_post_detail
+    assert response.headers["Surrogate-Key"] == f"post-{post_id}"
+
+    response = reader.get(f"/api/posts/{post_id}/comments")
+    assert response.headers["Surrogate-Key"] == f"post-{post_id}"
+
+
+def test_writes_purge_surrogate_keys(client, test_db, purger):
+    post_id = client.post("/api/posts", json={"title": "Edge", "content": "Content"}).json()["id"]
+    assert purger.purged == [["post-list"]]
+
+    client.post(f"/api/posts/{post_id}/comments", json={"content": "New", "author": "A"})
+    assert purger.purged[-1] == [f"post-{post_id}", "post-list"]
+
+    client.post("/api/posts/999/comments", json={"content": "New", "author": "A"})
+    assert len(purger.purged) == 2
+
+
+def test_orjson_and_pydantic_encodings_match(client, test_db, monkeypatch):
+    post_id = client.post("/api/posts", json={"title": "Encoded", "content": "Ünïcode ✓"}).json()["id"]
+    for i in range(3):
+        client.post(f"/api/posts/{post_id}/comments", json={"content": f"C{i}", "author": "A"})
+
+    urls = ["/api/posts", f"/api/posts/{post_id}?comments_limit=2", f"/api/posts/{post_id}/comments"]
+    fast = [client.get(url).content for url in urls]
+    monkeypatch.setattr(settings, "orjson_routes", "")
+    slow = [client.get(url).content for url in urls]
+
+    assert fast == slow
+    assert json.loads(fast[1])["comments_next_cursor"] is not None
+
+
+def test_export_ndjson(client, test_db, monkeypatch):
+    monkeypatch.setattr(settings, "export_watermark_margin_seconds", 0)
+    first = client.post("/api/posts", json={"title": "First", "content": "Content"}).json()["id"]
+    second = client.post("/api/posts", json={"title": "Second", "content": "Content"}).json()["id"]
+    for i in range(3):
+        client.post(f"/api/posts/{first}/comments", json={"content": f"C{i}", "author": "A"})
+
+    response = client.get("/api/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+
+    posts = [json.loads(line) for line in response.text.splitlines()]
+    assert [post["title"] for post in posts] == ["First", "Second"]
+    assert [c["content"] for c in posts[0]["comments"]] == ["C0", "C1", "C2"]
+    assert posts[0]["comment_count"] == 3
+    assert posts[1]["comments"] == []
+
+    # Incremental export: only posts changed or commented on since the watermark.
+    watermark = response.headers["X-Export-Watermark"]
+    client.post("/api/posts", json={"title": "Third", "content": "Content"})
+    client.post(f"/api/posts/{second}/comments", json={"content": "Late", "author": "A"})
+
+    response = client.get("/api/export", params={"since": watermark})
+    posts = [json.loads(line) for line in response.text.splitlines()]
+    assert [post["title"] for post in posts] == ["Second", "Third"]
+    assert [c["content"] for c in posts[0]["comments"]] == ["Late"]
+
+
+def test_export_watermark_trails_by_margin(client, test_db):
+    client.post("/api/posts", json={"title": "First", "content": "Content"})
+    watermark = client.get("/api/export").headers["X-Export-Watermark"]
+    assert datetime.fromisoformat(watermark) < datetime.utcnow() - timedelta(seconds=59)
+
+    # A post timestamped before the export but committed after it is still
+    # in the next incremental export.
+    with Session(engine) as db:
+        written_at = datetime.utcnow() - timedelta(seconds=5)
+        db.add(BlogPost(title="Late", content="Content", created_at=written_at, updated_at=written_at))
+        db.commit()
+    response = client.get("/api/export", params={"since": watermark})
+    assert [json.loads(line)["title"] for line in response.text.splitlines()] == ["First", "Late"]
+
+
+def test_create_posts_bulk(client, test_db):
+    posts = [{"title": f"Imported {i}", "content": "Content"} for i in range(5)]
+
+    with count_queries() as statements:
+        response = client.post("/api/posts/bulk", json=posts)
+    assert response.status_code == 201
+    assert response.json()["count"] == 5
+    assert sum(s.startswith("INSERT") for s in statements) == 1
+
+    ids = response.json()["ids"]
+    titles = [client.get(f"/api/posts/{post_id}").json()["title"] for post_id in ids]
+    assert titles == [post["title"] for post in posts]
+
+
+def test_create_posts_bulk_ndjson(client, test_db, monkeypatch):
+    monkeypatch.setattr(settings, "bulk_chunk_size", 2)
+    body = "\n".join(json.dumps({"title": f"Line {i}", "content": "Content"}) for i in range(5))
+
+    response = client.post(
+        "/api/posts/bulk", content=body, headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert response.status_code == 201
+    assert response.json()["count"] == 5
+    assert [post["title"] for post in client.get("/api/posts").json()] == [f"Line {i}" for i in reversed(range(5))]
+
+
+def test_create_posts_bulk_validation(client, test_db):
+    response = client.post("/api/posts/bulk", json=[{"title": "Fine", "content": "Content"}, {"title": ""}])
+    assert response.status_code == 422
+    assert {tuple(error["loc"]) for error in response.json()["detail"]} == {
+        ("body", 1, "title"), ("body", 1, "content")
+    }
+    # Nothing is inserted when any item is invalid.
+    assert client.get("/api/posts").json() == []
+
+    assert client.post("/api/posts/bulk", content="{not json").status_code == 422
+    assert client.post("/api/posts/bulk", json={"title": "Not a list"}).status_code == 422
+
+
+def test_create_comments_bulk(client, test_db, purger):
+    first = client.post("/api/posts", json={"title": "First", "content": "Content"}).json()["id"]
+    second = client.post("/api/posts", json={"title": "Second", "content": "Content"}).json()["id"]
+    purger.purged.clear()
+
+    items = [
+        {"post_id": first, "content": "One", "author": "A"},
+        {"post_id": 999, "content": "Orphan", "author": "A"},
+        {"post_id": second, "content": "Two", "author": "A"},
+        {"post_id": first, "content": "", "author": "A"},
+        {"post_id": first, "content": "Three", "author": "A"},
+    ]
+    with count_queries() as statements:
+        response = client.post("/api/comments/bulk", json=items)
+    assert response.status_code == 200
+    assert sum(s.startswith("INSERT") for s in statements) == 1
+    assert sum(s.startswith("UPDATE") for s in statements) == 1
+
+    data = response.json()
+    assert (data["created"], data["failed"]) == (3, 2)
+    assert [result["status"] for result in data["results"]] == [201, 404, 201, 422, 201]
+    assert data["results"][3]["detail"][0]["loc"] == ["content"]
+
+    post = client.get(f"/api/posts/{first}").json()
+    assert post["comment_count"] == 2
+    assert [c["content"] for c in post["comments"]] == ["One", "Three"]
+    assert [c["id"] for c in post["comments"]] == [data["results"][0]["id"], data["results"][4]["id"]]
+    assert client.get(f"/api/posts/{second}").json()["comment_count"] == 1
+
+    # One invalidation for the whole batch, covering every affected post.
+    assert purger.purged == [[f"post-{first}", f"post-{second}", "post-list"]]
+
+
+def test_create_statement_counts(client, test_db):
+    with count_queries() as statements:
+        post = client.post("/api/posts", json={"title": "Counted", "content": "Content"}).json()
+    assert len(statements) == 1
+    assert statements[0].startswith("INSERT") and "RETURNING" in statements[0]
+    assert post["created_at"] == post["updated_at"]
+
+    with count_queries() as statements:
+        client.post(f"/api/posts/{post['id']}/comments", json={"content": "Hi", "author": "A"})
+    assert not any("FROM blog_posts" in s or "FROM comments" in s for s in statements)
+    assert len(statements) == 2
+
+
+def test_create_comment_on_nonexistent_post_without_foreign_keys(client, test_db, monkeypatch):
+    unenforced = create_db_engine(
+        SQLALCHEMY_DATABASE_URL, Settings(db_pool_class="null", sqlite_foreign_keys=False)
+    )
+    session_factory = async_sessionmaker(bind=unenforced, expire_on_commit=False)
+
+    async def get_unenforced_db():
+        async with session_factory() as db:
+            yield db
+
+    monkeypatch.setitem(app.dependency_overrides, get_db, get_unenforced_db)
+    response = client.post("/api/posts/999/comments", json={"content": "Comment", "author": "Author"})
+    assert response.status_code == 404
+
+    with engine.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(Comment)).scalar() == 0
+
+
+@pytest.fixture
+def comment_writer(monkeypatch):
+    writer = CommentWriter(TestingSessionLocal, batch_size=50, window_seconds=0.05)
+    monkeypatch.setattr("main.comment_writer", writer)
+    return writer
+
+
+def test_group_commit_comments(client, test_db, comment_writer, purger, monkeypatch):
+    post_id = client.post("/api/posts", json={"title": "Busy", "content": "Content"}).json()["id"]
+    purger.purged.clear()
+    monkeypatch.setattr(settings, "comment_write_mode", "group_commit")
+
+    async def run():
+        async with httpx.AsyncClient(app=app, base_url="http://test") as ac:
+            created = await asyncio.gather(*[
+                ac.post(f"/api/posts/{post_id}/comments", json={"content": f"C{i}", "author": "A"})
+                for i in range(20)
+            ])
+            missing = await ac.post("/api/posts/999/comments", json={"content": "C", "author": "A"})
+        await comment_writer.stop()
+        return created, missing
+
+    created, missing = asyncio.run(run())
+    assert all(r.status_code == 201 for r in created)
+    assert len({r.json()["id"] for r in created}) == 20
+    assert missing.status_code == 404
+    # Twenty concurrent comments share a commit instead of taking one each.
+    assert comment_writer.commits <= 3
+
+    post = client.get(f"/api/posts/{post_id}").json()
+    assert post["comment_count"] == 20
+    assert purger.purged[0] == [f"post-{post_id}", "post-list"]
+
+
+def test_group_commit_survives_post_commit_failures(client, test_db, comment_writer, monkeypatch):
+    post_id = client.post("/api/posts", json={"title": "Busy", "content": "Content"}).json()["id"]
+
+    class BrokenCache(CacheBackend):
+        async def invalidate(self, tags):
+            raise RuntimeError("cache down")
+
+    class SlowPurger(RecordingPurger):
+        async def purge(self, keys):
+            await asyncio.sleep(0.5)
+            await super().purge(keys)
+
+    purger = SlowPurger()
+    monkeypatch.setattr("main.response_cache", BrokenCache())
+    monkeypatch.setattr("main.purger", purger)
+    comment_writer.window_seconds = 0
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        comments = []
+        for i in range(6):
+            comments.append(await asyncio.wait_for(
+                comment_writer.submit(post_id, main.CommentCreate(content=f"C{i}", author="A")), 1
+            ))
+        # Every commit answered without waiting for the CDN.
+        elapsed = loop.time() - started
+        await comment_writer.stop()
+        return comments, elapsed
+
+    comments, elapsed = asyncio.run(run())
+    assert [c["content"] for c in comments] == [f"C{i}" for i in range(6)]
+    assert elapsed < 0.5
+    assert len(purger.purged) == 6
+    with engine.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(Comment)).scalar() == 6
+
+
+def test_write_behind_comments(client, test_db, comment_writer, monkeypatch):
+    post_id = client.post("/api/posts", json={"title": "Busy", "content": "Content"}).json()["id"]
+    monkeypatch.setattr(settings, "comment_write_mode", "write_behind")
+
+    async def run():
+        async with httpx.AsyncClient(app=app, base_url="http://test") as ac:
+            accepted = await asyncio.gather(*[
+                ac.post(f"/api/posts/{post_id}/comments", json={"content": f"C{i}", "author": "A"})
+                for i in range(5)
+            ])
+            missing = await ac.post("/api/posts/999/comments", json={"content": "C", "author": "A"})
+        # Shutting down writes whatever is still queued.
+        await comment_writer.stop()
+        return accepted, missing
+
+    accepted, missing = asyncio.run(run())
+    assert all(r.status_code == 202 for r in accepted)
+    assert all(r.json() == {"post_id": post_id} for r in accepted)
+    assert missing.status_code == 404
+
+    post = client.get(f"/api/posts/{post_id}").json()
+    assert post["comment_count"] == 5
+    assert sorted(c["content"] for c in post["comments"]) == [f"C{i}" for i in range(5)]
+
+
+def test_search_posts_and_comments(client, test_db):
+    rust = client.post("/api/posts", json={"title": "Learning Rust", "content": "Ownership and borrowing."}).json()
+    python = client.post(
+        "/api/posts", json={"title": "Python tips", "content": "Some notes that mention rust in passing."}
+    ).json()
+    client.post(f"/api/posts/{python['id']}/comments", json={"content": "Rusting bikes are sad", "author": "A"})
+    client.post(f"/api/posts/{python['id']}/comments", json={"content": "Unrelated", "author": "B"})
+
+    response = client.get("/api/search", params={"q": "rust"})
+    assert response.status_code == 200
+    hits = response.json()
+    # A title match outranks a body match; stemming finds "Rusting".
+    assert [(h["kind"], h["post_id"]) for h in hits] == [
+        ("post", rust["id"]), ("post", python["id"]), ("comment", python["id"])
+    ]
+    assert hits[0]["title"] == "Learning <mark>Rust</mark>"
+    assert "<mark>rust</mark>" in hits[1]["snippet"]
+    assert hits[2]["title"] == "Python tips"
+    assert hits[2]["snippet"] == "<mark>Rusting</mark> bikes are sad"
+
+    assert client.get("/api/search", params={"q": "borrowing ownership"}).json()[0]["id"] == rust["id"]
+    assert client.get("/api/search", params={"q": "golang"}).json() == []
+    assert client.get("/api/search", params={"q": '"*) OR'}).json() == []
+    assert client.get("/api/search", params={"q": ""}).status_code == 422
+
+
+def test_search_escapes_html(client, test_db):
+    post = client.post(
+        "/api/posts", json={"title": "<script>alert(1)</script> rust", "content": "Rust & <b>friends</b>"}
+    ).json()
+    client.post(f"/api/posts/{post['id']}/comments", json={"content": "<img src=x> rust", "author": "A"})
+
+    hits = client.get("/api/search", params={"q": "rust"}).json()
+    assert hits[0]["title"] == "&lt;script&gt;alert(1)&lt;/script&gt; <mark>rust</mark>"
+    assert hits[0]["snippet"] == "<mark>Rust</mark> &amp; &lt;b&gt;friends&lt;/b&gt;"
+    assert hits[1]["title"] == "&lt;script&gt;alert(1)&lt;/script&gt; rust"
+    assert hits[1]["snippet"] == "&lt;img src=x&gt; <mark>rust</mark>"
+
+
+def test_search_pagination(client, test_db):
+    client.post("/api/posts/bulk", json=[
+        {"title": f"Search post {i}", "content": "search " * (i % 3 + 1)} for i in range(7)
+    ])
+
+    seen, cursor = [], None
+    while True:
+        params = {"q": "search", "limit": 3}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/api/search", params=params)
+        seen += [(h["kind"], h["id"], h["score"]) for h in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert len(seen) == 7
+    assert len({(kind, id) for kind, id, _ in seen}) == 7
+    assert [score for _, _, score in seen] == sorted(score for _, _, score in seen)
+
+    assert client.get("/api/search", params={"q": "search", "cursor": "bogus"}).status_code == 400
+
+
+def test_rebuild_search_index(client, test_db):
+    post = client.post("/api/posts", json={"title": "Indexed", "content": "Findable"}).json()
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO blog_posts_fts(blog_posts_fts) VALUES ('delete-all')"))
+    assert client.get("/api/search", params={"q": "findable"}).json() == []
+
+    asyncio.run(rebuild_search_index(async_engine))
+    assert [h["id"] for h in client.get("/api/search", params={"q": "findable"}).json()] == [post["id"]]
+
+
+def test_suggest_posts(client, test_db):
+    for title in ["Rust ownership", "rust macros", "Rusty nails", "Python tips", "A rust primer"]:
+        client.post("/api/posts", json={"title": title, "content": "Content"})
+    client.post("/api/posts/bulk", json=[{"title": "Rust in production", "content": "Content"}])
+
+    response = client.get("/api/posts/suggest", params={"prefix": "RUST"})
+    assert response.status_code == 200
+    assert [s["title"] for s in response.json()] == [
+        "Rust in production", "rust macros", "Rust ownership", "Rusty nails"
+    ]
+    assert len(client.get("/api/posts/suggest", params={"prefix": "rust", "limit": 2}).json()) == 2
+    assert client.get("/api/posts/suggest", params={"prefix": "zzz"}).json() == []
+    assert client.get("/api/posts/suggest", params={"prefix": ""}).status_code == 422
+
+
+def test_suggest_picks_up_posts_written_elsewhere(client, test_db):
+    client.get("/api/posts/suggest", params={"prefix": "x"})
+    with engine.begin() as conn:
+        conn.execute(BlogPost.__table__.insert(), [{"title": "Written by another worker", "content": "C"}])
+    assert client.get("/api/posts/suggest", params={"prefix": "written"}).json() == []
+
+    title_index._refreshed_at = float("-inf")
+    assert [s["title"] for s in client.get("/api/posts/suggest", params={"prefix": "written"}).json()] == [
+        "Written by another worker"
+    ]
+
+
+def test_title_index_is_bounded():
+    index = TitleIndex(max_titles=3, refresh_seconds=60)
+    for post_id, title in enumerate(["b", "a", "c", "d", "ab"], start=1):
+        index.add(post_id, title)
+    assert len(index) == 3
+    # The two oldest posts were evicted.
+    assert index.suggest("a", 10) == [{"id": 5, "title": "ab"}]
+    assert [s["title"] for s in index.suggest("", 10)] == ["ab", "c", "d"]
+
+
+def test_server_timing_reports_queries(client, test_db):
+    post = client.post("/api/posts", json={"title": "Timed", "content": "Content"}).json()
+    response = TestClient(app).get(f"/api/posts/{post['id']}")
+    assert response.headers["Server-Timing"].startswith("db;dur=")
+    assert response.headers["Server-Timing"].endswith('desc="3 queries"')
+
+
+def test_query_budget_and_repeated_statements(caplog, monkeypatch):
+    stats = QueryStats()
+    for _ in range(6):
+        stats.record("SELECT comments.id FROM comments WHERE comments.blog_post_id = ?", 0.001)
+    stats.record("SELECT blog_posts.id FROM blog_posts", 0.001)
+    scope = {"method": "GET", "path": "/api/posts"}
+
+    monkeypatch.setattr(settings, "sql_query_budget", 7)
+    with caplog.at_level("INFO", logger="main"):
+        report_queries(scope, stats)
+    record = next(r for r in caplog.records if hasattr(r, "sql"))
+    assert record.sql["queries"] == 7
+    assert record.sql["repeated"] == [
+        {"statement": "SELECT comments.id FROM comments WHERE comments.blog_post_id = ?", "count": 6}
+    ]
+    assert any("Possible N+1" in r.getMessage() for r in caplog.records)
+
+    monkeypatch.setattr(settings, "sql_query_budget", 6)
+    with pytest.raises(QueryBudgetExceeded, match="7 queries, over its budget of 6"):
+        report_queries(scope, stats)
+
+    monkeypatch.setattr(settings, "sql_query_budget_action", "log")
+    report_queries(scope, stats)
+    assert "over its budget of 6" in caplog.records[-1].getMessage()
+
+
+def test_failed_statements_are_recorded():
+    async def run():
+        static = create_db_engine("sqlite+aiosqlite://", Settings(db_pool_class="static"))
+        async with static.begin() as conn:
+            await conn.execute(text("CREATE TABLE tags (name TEXT PRIMARY KEY)"))
+            await conn.execute(text("INSERT INTO tags VALUES ('a')"))
+
+        stats = QueryStats()
+        token = main.current_queries.set(stats)
+        try:
+            for _ in range(5):
+                async with static.connect() as conn:
+                    with pytest.raises(IntegrityError):
+                        await conn.execute(text("INSERT INTO tags VALUES ('a')"))
+        finally:
+            main.current_queries.reset(token)
+
+        async with static.connect() as conn:
+            # Nothing left behind on the shared connection.
+            assert not conn.sync_connection.info.get("query_started")
+        await static.dispose()
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats.statements == {"INSERT INTO tags VALUES ('a')": 5}
+
+
+def test_metrics(client, test_db):
+    post = client.post("/api/posts", json={"title": "Measured", "content": "Content"}).json()
+    reader = TestClient(app)
+    reader.get(f"/api/posts/{post['id']}")
+    reader.get(f"/api/posts/{post['id']}")
+    client.get("/api/posts/999")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+
+    def value(prefix):
+        return float(next(line for line in lines if line.startswith(prefix)).rsplit(" ", 1)[1])
+
+    route = 'method="GET",route="/api/posts/{post_id}"'
+    assert value(f'http_request_duration_seconds_count{{{route},status="200"}}') >= 2
+    assert value(f'http_request_duration_seconds_count{{{route},status="404"}}') >= 1
+    assert value(f'http_request_duration_seconds_bucket{{{route},status="200",le="+Inf"}}') >= 2
+    # Only the /metrics request itself is in flight.
+    assert value("http_requests_in_flight") == 1
+    assert value('response_cache_hits_total{backend="memory"}') >= 1
+    assert 0 < value('response_cache_hit_ratio{backend="memory"}') < 1
+    assert value('db_pool_checkout_wait_seconds_count{engine="primary",pool="null"}') >= 1
+    assert value('response_serialization_seconds_count{route="get_post"}') >= 1
+
+
+@pytest.fixture
+def traced(monkeypatch):
+    """Switch tracing on at a sample ratio; returns the exporter collecting the spans."""
+    pytest.importorskip("opentelemetry.sdk")
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    def trace_with(sample_ratio):
+        exporter = InMemorySpanExporter()
+        provider = main.create_tracer_provider(Settings(tracing_sample_ratio=sample_ratio), exporter)
+        monkeypatch.setattr(main, "tracer", provider.get_tracer("test"))
+        return exporter
+
+    return trace_with
+
+
+def test_tracing_spans(client, test_db, traced):
+    post = client.post("/api/posts", json={"title": "Traced", "content": "Content"}).json()
+    spans = traced(1.0)
+    client.get(f"/api/posts/{post['id']}")
+
+    finished = {span.name: span for span in spans.get_finished_spans()}
+    request = finished["GET /api/posts/{post_id}"]
+    assert request.attributes["http.status_code"] == 200
+    assert finished["serialize"].attributes["route"] == "get_post"
+    queries = [span for span in spans.get_finished_spans() if span.name == "SELECT"]
+    assert len(queries) == 3
+    assert all(span.attributes["db.statement"].startswith("SELECT") for span in queries)
+    # Everything hangs off the request span.
+    assert {span.context.trace_id for span in spans.get_finished_spans()} == {request.context.trace_id}
+    assert all(span.parent.span_id == request.context.span_id for span in queries)
+
+
+def test_tracing_sampling(client, test_db, traced):
+    spans = traced(0.0)
+    client.get("/api/posts")
+    assert spans.get_finished_spans() == ()
+
+    # A sampled parent overrides the ratio.
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    client.get("/api/posts", headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"})
+    finished = spans.get_finished_spans()
+    assert finished and all(format(span.context.trace_id, "032x") == trace_id for span in finished)
+
+
+def test_comment_writer_does_not_join_the_first_request_trace(client, test_db, traced, comment_writer, monkeypatch):
+    post_id = client.post("/api/posts", json={"title": "Traced", "content": "Content"}).json()["id"]
+    spans = traced(0.0)
+    monkeypatch.setattr(settings, "comment_write_mode", "group_commit")
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+    async def run():
+        async with httpx.AsyncClient(app=app, base_url="http://test") as ac:
+            # A sampled request starts the writer...
+            await ac.post(
+                f"/api/posts/{post_id}/comments",
+                json={"content": "First", "author": "A"},
+                headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"}
+            )
+            first = len(spans.get_finished_spans())
+            # ...and unsampled ones that follow must not end up in its trace.
+            for i in range(5):
+                await ac.post(f"/api/posts/{post_id}/comments", json={"content": f"C{i}", "author": "A"})
+        await comment_writer.stop()
+        return first
+
+    first = asyncio.run(run())
+    finished = spans.get_finished_spans()
+    assert len(finished) == first
+    assert all(format(span.context.trace_id, "032x") == trace_id for span in finished)
+    assert not any(span.name == "INSERT" for span in finished)